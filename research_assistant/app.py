@@ -6,34 +6,77 @@
 - /api/upload      上传 PDF
 - /api/documents   获取已加载文档列表
 - /api/ask         提问（RAG 问答）
-- /api/compare     多文档对比分析（至少 2 篇文档）
+- /api/ask_stream  提问（SSE 流式返回：逐 token 推送，最后推送 done 事件附带来源）
+- /api/compare     多文档对比分析（至少 2 篇文档，后台任务）
+- /api/jobs/<id>   查询后台任务状态/结果
 
 说明：
 - 后端会在首次提问/对比或上传后自动初始化向量库与 QA 链；
-- 上传新文档后会强制重建索引，确保新文档被纳入检索。
+- 上传新文档后只对新增（或内容变化）的 PDF 做增量入库；
+  表单字段 rebuild=1 可强制整体重建索引（管理用途）；
+- /api/compare 耗时较长，改为提交后台任务：立即返回 job_id（202），
+  前端轮询 /api/jobs/<job_id> 获取状态与结果。
 '''
 from __future__ import annotations
 
-from flask import Flask, request, jsonify, render_template_string
+from flask import Flask, Response, request, jsonify, render_template_string, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
+from collections import OrderedDict
 from pathlib import Path
+import hashlib
 import os
+import threading
+import time
+import uuid
 from typing import Any, Dict, List, Tuple, Optional
 
 from assistant import ResearchAssistant
 
+# 可选依赖：orjson（更快的 JSON 序列化，直接输出 UTF-8）、Flask-Compress（gzip/br 压缩响应）
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from flask_compress import Compress
+except ImportError:
+    Compress = None
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """用 orjson 序列化 JSON 响应；中文按 UTF-8 原样输出，不转义为 \\uXXXX"""
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s: str | bytes, **kwargs: Any) -> Any:
+        return orjson.loads(s)
+
 
 app = Flask(__name__)
 CORS(app)
 
+if orjson is not None:
+    app.json = OrjsonProvider(app)
+else:
+    app.json.ensure_ascii = False
+
+if Compress is not None:
+    app.config["COMPRESS_MIN_SIZE"] = 1024
+    # SSE 必须逐条下发，不能被压缩缓冲
+    app.config["COMPRESS_STREAMS"] = False
+    Compress(app)
+
 # =========================
 # 配置
 # =========================
 UPLOAD_FOLDER = os.getenv("DOCS_FOLDER", "./documents")
 INDEX_DIR = os.getenv("FAISS_INDEX_DIR", "./faiss_index")
 
-ALLOWED_EXTENSIONS = {"pdf"}
+ALLOWED_EXTENSIONS = (".pdf",)
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
 app.config["MAX_CONTENT_LENGTH"] = 16 * 1024 * 1024  # 16MB
 
@@ -53,7 +96,38 @@ assistant = ResearchAssistant(
 
 
 def allowed_file(filename: str) -> bool:
-    return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
+    return filename.lower().endswith(ALLOWED_EXTENSIONS)
+
+
+def _pdf_filename(filename: str) -> str:
+    """secure_filename 会丢掉所有非 ASCII 字符（"深度学习.pdf" -> "pdf"），
+    此时改用原文件名的哈希作为文件名，保证仍以 .pdf 结尾且同名上传映射到同一文件"""
+    name = secure_filename(filename)
+    # 扩展名统一小写，与 glob("*.pdf") 一致
+    if name.lower().endswith(".pdf") and Path(name).stem:
+        return Path(name).stem + ".pdf"
+    return hashlib.sha1(filename.encode("utf-8")).hexdigest()[:16] + ".pdf"
+
+
+def _save_and_hash(file: Any, filepath: Path) -> str:
+    """边写盘边计算 sha256，避免入库去重时再读一遍文件"""
+    h = hashlib.sha256()
+    with open(filepath, "wb") as out:
+        for block in iter(lambda: file.stream.read(1 << 20), b""):
+            h.update(block)
+            out.write(block)
+    return h.hexdigest()
+
+
+# 来源/页码字段在不同 loader 版本里名字不同，按顺序尝试
+_SOURCE_KEYS = ("source_file", "source")
+_PAGE_KEYS = ("page", "page_number")
+
+# 同一批 source_documents（例如语义缓存命中时返回的同一个列表）只提炼一次；
+# 条目里保留列表本身的引用，既防止 id 被复用，也能在命中时校验身份
+_SOURCES_CACHE_SIZE = 256
+_sources_cache: "OrderedDict[int, Tuple[Any, List[str]]]" = OrderedDict()
+_sources_lock = threading.Lock()
 
 
 def _extract_sources(source_documents: Any) -> List[str]:
@@ -61,43 +135,98 @@ def _extract_sources(source_documents: Any) -> List[str]:
     if not source_documents:
         return []
 
+    key = id(source_documents)
+    with _sources_lock:
+        hit = _sources_cache.get(key)
+        if hit is not None and hit[0] is source_documents:
+            _sources_cache.move_to_end(key)
+            return hit[1]
+
     sources: List[str] = []
     for d in source_documents:
         try:
             meta = getattr(d, "metadata", {}) or {}
-            src = meta.get("source_file") or meta.get("source") or "未知来源"
+            src = next((meta[k] for k in _SOURCE_KEYS if meta.get(k)), "未知来源")
             # PyPDFLoader 通常会给 page；不同版本字段可能不同，做兼容
-            page = meta.get("page")
-            if page is None:
-                page = meta.get("page_number")
+            page = next((meta[k] for k in _PAGE_KEYS if meta.get(k) is not None), None)
+            section = meta.get("section")
             if page is not None:
-                sources.append(f"{src} (p.{int(page) + 1})")
+                loc = f"p.{int(page) + 1}, {section}" if section else f"p.{int(page) + 1}"
+                sources.append(f"{src} ({loc})")
             else:
                 sources.append(str(src))
         except Exception:
             continue
 
     # 去重但保持顺序
-    seen = set()
-    uniq: List[str] = []
-    for s in sources:
-        if s not in seen:
-            uniq.append(s)
-            seen.add(s)
+    uniq = list(dict.fromkeys(sources))
+
+    with _sources_lock:
+        _sources_cache[key] = (source_documents, uniq)
+        if len(_sources_cache) > _SOURCES_CACHE_SIZE:
+            _sources_cache.popitem(last=False)
     return uniq
 
 
+# =========================
+# 后台任务（长耗时的 compare 不占用 HTTP 连接）
+# =========================
+JOB_TTL = 3600  # 已结束任务保留时长（秒）
+_jobs: Dict[str, Dict[str, Any]] = {}
+_jobs_lock = threading.Lock()
+
+
+def _submit_job(target: Any) -> str:
+    """在守护线程中运行 target()，target 返回 (payload, ok)。"""
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    with _jobs_lock:
+        # 顺带清理过期的已结束任务
+        for jid in [j for j, v in _jobs.items() if v["status"] != "running" and now - v["started_at"] > JOB_TTL]:
+            del _jobs[jid]
+        _jobs[job_id] = {"status": "running", "result": None, "error": None, "started_at": now}
+
+    def _run():
+        try:
+            payload, ok = target()
+            update = {"status": "done", "result": payload} if ok else {"status": "error", "error": payload}
+        except Exception as e:
+            update = {"status": "error", "error": f"任务执行失败: {e}"}
+        with _jobs_lock:
+            _jobs[job_id].update(update)
+
+    threading.Thread(target=_run, daemon=True).start()
+    return job_id
+
+
+# 串行化所有会改动索引的操作（初始化 / 重建 / 增量入库）；可重入，便于上传时在持锁状态下调用 ensure_ready
+_ready_lock = threading.RLock()
+
+
 def ensure_ready(force_rebuild: bool = False) -> Tuple[bool, Optional[str]]:
-    """确保 documents_data / vectorstore / qa_chain 均已就绪。"""
+    """确保 documents_data / vectorstore / QA prompt 均已就绪。"""
     # 已就绪则直接返回，避免每次请求都重新加载/构建
-    if (not force_rebuild) and assistant.qa_chain and assistant.vectorstore and assistant.documents_data:
+    if (not force_rebuild) and assistant.qa_prompt and assistant.vectorstore and assistant.documents_data:
         return True, None
 
-    # 同步磁盘上的文档状态（避免 documents_data 残留已删除文件）
-    assistant.documents_data.clear()
-    docs = assistant.load_documents()
-    if not docs:
-        return False, "暂无文档，请先上传 PDF。"
+    # 启动预热线程与首个请求可能同时到达，串行化初始化，避免重复加载/构建
+    with _ready_lock:
+        if (not force_rebuild) and assistant.qa_prompt and assistant.vectorstore and assistant.documents_data:
+            return True, None
+        return _init_assistant(force_rebuild)
+
+
+def _init_assistant(force_rebuild: bool) -> Tuple[bool, Optional[str]]:
+    # 同步磁盘上的文档状态（避免 documents_data 残留已删除文件）；
+    # 清单与磁盘一致时直接恢复，无需重新解析 PDF
+    docs: List = []
+    if force_rebuild:
+        assistant.invalidate_docs()
+    if force_rebuild or not assistant.restore_documents():
+        assistant.documents_data.clear()
+        docs = assistant.load_documents()
+        if not docs:
+            return False, "暂无文档，请先上传 PDF。"
 
     # 强制重建仅在本次调用生效
     prev_rebuild = assistant.rebuild_index
@@ -149,7 +278,7 @@ HTML_TEMPLATE = r"""
                                 class="mt-4 w-full bg-indigo-600 text-white py-2 px-4 rounded-lg hover:bg-indigo-700 transition">
                             上传
                         </button>
-                        <p class="text-xs text-gray-500 mt-3">提示：上传后会重建索引，确保新文档可被检索。</p>
+                        <p class="text-xs text-gray-500 mt-3">提示：上传后会增量更新索引，新文档即可被检索。</p>
                     </div>
 
                     <div class="bg-white rounded-xl p-6 border border-gray-200">
@@ -219,7 +348,7 @@ HTML_TEMPLATE = r"""
             }
 
             try {
-                addMessage('system', `正在上传 ${files.length} 个文件并重建索引...`);
+                addMessage('system', `正在上传 ${files.length} 个文件并更新索引...`);
                 const response = await fetch(`${API_BASE}/api/upload`, {
                     method: 'POST',
                     body: formData
@@ -259,16 +388,28 @@ HTML_TEMPLATE = r"""
         async function compareDocs() {
             addMessage('user', 'compare');
             try {
-                const response = await fetch(`${API_BASE}/api/compare`);
+                const response = await fetch(`${API_BASE}/api/compare`, { method: 'POST' });
                 const data = await response.json();
                 if (!response.ok) throw new Error(data.error || '对比失败');
 
-                addAssistantAnswer(data);
+                addMessage('system', '对比分析已提交，正在生成...');
+                addAssistantAnswer(await pollJob(data.job_id));
             } catch (error) {
                 addMessage('system', '请求失败: ' + error.message);
             }
         }
 
+        async function pollJob(jobId) {
+            while (true) {
+                await new Promise(resolve => setTimeout(resolve, 2000));
+                const response = await fetch(`${API_BASE}/api/jobs/${jobId}`);
+                const job = await response.json();
+                if (!response.ok) throw new Error(job.error || '查询任务失败');
+                if (job.status === 'done') return job.result;
+                if (job.status === 'error') throw new Error(job.error);
+            }
+        }
+
         async function sendQuestion() {
             const input = document.getElementById('questionInput');
             const question = input.value.trim();
@@ -283,19 +424,29 @@ HTML_TEMPLATE = r"""
                 return compareDocs();
             }
 
-            try {
-                const response = await fetch(`${API_BASE}/api/ask`, {
-                    method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify({ question })
-                });
-                const data = await response.json();
-                if (!response.ok) throw new Error(data.error || '请求失败');
+            // 流式接收回答：token 逐段追加到同一个气泡，done 事件附带来源
+            const chatBox = document.getElementById('chatBox');
+            const answer = addMessage('assistant', '').querySelector('pre');
+            const es = new EventSource(`${API_BASE}/api/ask_stream?q=${encodeURIComponent(question)}`);
 
-                addAssistantAnswer(data);
-            } catch (error) {
-                addMessage('system', '请求失败: ' + error.message);
-            }
+            es.onmessage = (event) => {
+                answer.textContent += JSON.parse(event.data).token;
+                chatBox.scrollTop = chatBox.scrollHeight;
+            };
+            es.addEventListener('done', (event) => {
+                es.close();
+                const data = JSON.parse(event.data);
+                if (data.sources && data.sources.length > 0) {
+                    answer.textContent += `\n\n—— 参考来源 ——\n` + data.sources.map(s => `• ${s}`).join('\n');
+                }
+                chatBox.scrollTop = chatBox.scrollHeight;
+            });
+            // 服务端推送的 error 事件带 data；连接异常时浏览器触发的 error 事件不带
+            es.addEventListener('error', (event) => {
+                es.close();
+                const message = event.data ? JSON.parse(event.data).error : '连接中断';
+                addMessage('system', '请求失败: ' + message);
+            });
         }
 
         function addAssistantAnswer(data) {
@@ -327,6 +478,7 @@ HTML_TEMPLATE = r"""
 
             chatBox.appendChild(messageDiv);
             chatBox.scrollTop = chatBox.scrollHeight;
+            return messageDiv;
         }
 
         // 初始加载
@@ -348,12 +500,14 @@ def index():
 
 @app.route("/api/upload", methods=["POST"])
 def upload_files():
-    """上传 PDF 文件（上传后强制重建索引）"""
+    """上传 PDF 文件（上传后增量更新索引）"""
     if "files" not in request.files:
         return jsonify({"error": "没有文件"}), 400
 
     files = request.files.getlist("files")
+    upload_folder = Path(app.config["UPLOAD_FOLDER"])
     uploaded: List[str] = []
+    digests: Dict[str, str] = {}
 
     for file in files:
         if not file or not file.filename:
@@ -361,21 +515,47 @@ def upload_files():
         if not allowed_file(file.filename):
             continue
 
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config["UPLOAD_FOLDER"], filename)
-        file.save(filepath)
+        filename = _pdf_filename(file.filename)
+        digests[filename] = _save_and_hash(file, upload_folder / filename)
         uploaded.append(filename)
 
     if not uploaded:
         return jsonify({"error": "没有上传有效的 PDF 文件"}), 400
 
-    ok, err = ensure_ready(force_rebuild=True)
-    if not ok:
-        return jsonify({"error": err}), 500
+    # 目录内容已变化，让下一次扫描不走缓存
+    assistant.invalidate_docs()
+
+    # 整体重建只作为显式的管理操作保留
+    if request.form.get("rebuild") == "1":
+        ok, err = ensure_ready(force_rebuild=True)
+        if not ok:
+            return jsonify({"error": err}), 500
+        return jsonify(
+            {
+                "message": f"成功上传 {len(uploaded)} 个文件，并已重建索引",
+                "files": uploaded,
+            }
+        )
+
+    with _ready_lock:
+        # 首次上传时 ensure_ready 可能已把新文件建进索引，add_documents 会跳过它们；
+        # 以清单前后的哈希变化判断本次真正入库的文件，再统计其文本块数
+        before = assistant.indexed_files()
+        ok, err = ensure_ready(force_rebuild=False)
+        if not ok:
+            return jsonify({"error": err}), 500
+
+        try:
+            assistant.add_documents((upload_folder / name for name in uploaded), digests)
+        except Exception as e:
+            return jsonify({"error": f"更新索引失败: {e}"}), 500
+
+        after = assistant.indexed_files()
+        added = assistant.chunk_count(n for n in uploaded if after.get(n) != before.get(n))
 
     return jsonify(
         {
-            "message": f"成功上传 {len(uploaded)} 个文件，并已重建索引",
+            "message": f"成功上传 {len(uploaded)} 个文件，新增 {added} 个文本块到索引",
             "files": uploaded,
         }
     )
@@ -384,10 +564,12 @@ def upload_files():
 @app.route("/api/documents", methods=["GET"])
 def list_documents():
     """列出已加载的文档"""
-    # 懒加载：如果内存里还没加载，就从磁盘同步一次
+    # 懒加载：如果内存里还没加载，就从磁盘同步一次；
+    # 与预热 / 初始化串行，持锁后再检查，避免重复解析及并发改动 documents_data
     if not assistant.documents_data:
-        assistant.documents_data.clear()
-        assistant.load_documents()
+        with _ready_lock:
+            if not assistant.documents_data and not assistant.restore_documents():
+                assistant.load_documents()
 
     return jsonify({"documents": list(assistant.documents_data.keys())})
 
@@ -413,25 +595,93 @@ def ask_question():
     return jsonify({"answer": result.get("result", ""), "sources": sources})
 
 
-@app.route("/api/compare", methods=["GET"])
-def compare_documents():
-    """多文档比较分析"""
+def _sse(data: Dict[str, Any], event: Optional[str] = None) -> str:
+    payload = app.json.dumps(data)
+    return f"event: {event}\ndata: {payload}\n\n" if event else f"data: {payload}\n\n"
+
+
+@app.route("/api/ask_stream", methods=["GET"])
+def ask_stream():
+    """回答问题（SSE 流式）：?q=问题"""
+    question = (request.args.get("q") or "").strip()
+
+    def generate():
+        # EventSource 读不到非 200 响应的内容，错误也以 error 事件推送
+        if not question:
+            yield _sse({"error": "问题不能为空"}, "error")
+            return
+        ok, err = ensure_ready(force_rebuild=False)
+        if not ok:
+            yield _sse({"error": err}, "error")
+            return
+
+        for item in assistant.ask_stream(question):
+            if "token" in item:
+                yield _sse({"token": item["token"]})
+            elif "error" in item:
+                yield _sse({"error": item["error"]}, "error")
+            else:
+                yield _sse({"sources": _extract_sources(item.get("source_documents"))}, "done")
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def _run_compare() -> Tuple[Any, bool]:
+    # 冷启动时初始化（解析 + 嵌入全部文档）可能耗时数分钟，放在后台任务里执行
     ok, err = ensure_ready(force_rebuild=False)
     if not ok:
-        return jsonify({"error": err}), 400
+        return err, False
 
     result = assistant.compare_documents()
 
     # compare_documents 可能返回 str 或 dict
     if isinstance(result, str):
-        return jsonify({"result": result, "sources": []})
+        return {"result": result, "sources": []}, True
 
     if isinstance(result, dict) and "error" in result:
-        return jsonify({"error": result["error"]}), 500
+        return result["error"], False
 
     sources = _extract_sources(result.get("source_documents") if isinstance(result, dict) else None)
     text = result.get("result", "") if isinstance(result, dict) else str(result)
-    return jsonify({"result": text, "sources": sources})
+    return {"result": text, "sources": sources}, True
+
+
+@app.route("/api/compare", methods=["POST"])
+def compare_documents():
+    """多文档比较分析（提交后台任务，返回 job_id；初始化失败通过任务的 error 字段返回）"""
+    return jsonify({"job_id": _submit_job(_run_compare)}), 202
+
+
+@app.route("/api/jobs/<job_id>", methods=["GET"])
+def get_job(job_id: str):
+    """查询后台任务状态：running / done / error"""
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        job = dict(job) if job else None
+    if job is None:
+        return jsonify({"error": "任务不存在或已过期"}), 404
+    return jsonify(job)
+
+
+def _warmup():
+    """后台预热：加载索引、触发 embedding 模型 / FAISS 首次访问、加载生成模型，
+    让首个用户请求不再承担冷启动开销。"""
+    ok, err = ensure_ready(force_rebuild=False)
+    if not ok:
+        print(f"[预热] 跳过: {err}")
+        return
+    try:
+        # 空 prompt 只加载模型、不生成，并记录 _llm_last_used，避免首个提问再发一次预加载
+        assistant._preload_llm()
+        # 走与提问相同的检索路径（持有 _index_lock），不与上传时的索引更新竞争
+        assistant._retrieve(assistant._embed_question("warmup"))
+        print("[预热] ✓ 检索已就绪，生成模型后台加载中")
+    except Exception as e:
+        print(f"[预热] 失败: {e}")
 
 
 if __name__ == "__main__":
@@ -443,4 +693,9 @@ if __name__ == "__main__":
     print("🌐 访问地址: http://localhost:5000")
     print("=" * 60 + "\n")
 
-    app.run(debug=True, host="0.0.0.0", port=5000)
+    debug = True
+    # debug 模式下 reloader 父进程不处理请求，只在实际服务的子进程里预热；非 debug 直接预热
+    if (not debug or os.environ.get("WERKZEUG_RUN_MAIN")) and any(Path(UPLOAD_FOLDER).glob("*.pdf")):
+        threading.Thread(target=_warmup, daemon=True).start()
+
+    app.run(debug=debug, host="0.0.0.0", port=5000)
@@ -19,19 +19,47 @@
 
 from __future__ import annotations
 
+from collections import deque
+from collections.abc import Sequence
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import cached_property, lru_cache
 from pathlib import Path
-from typing import Any, Dict, List
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Tuple
 import argparse
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import re
+import threading
+import time
+import uuid
+
+import faiss
+import httpx
+import numpy as np
+import ollama
 
 from langchain_community.document_loaders import PyPDFLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_community.vectorstores import FAISS
-from langchain_core.prompts import PromptTemplate
-
-# RetrievalQA 的导入在不同版本 LangChain 中可能不同，做兼容
+from langchain_community.vectorstores.utils import DistanceStrategy
+from langchain_core.documents import Document
 
-from langchain_classic.chains import RetrievalQA
+# PDF 解析优先用 PyMuPDF（按版面块提取，段落边界保留得更好），未安装时退回 pypdf
+try:
+    import fitz  # noqa: F401
+    from langchain_community.document_loaders import PyMuPDFLoader as PDFLoader
+except ImportError:
+    PDFLoader = PyPDFLoader
 
+# 分块长度按 token 计（与 embedding / LLM 上下文一致），未安装 tiktoken 时退回按字符计
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
 
 # Ollama LLM 的导入因版本可能不同，做兼容
 
@@ -43,6 +71,200 @@ from langchain_ollama import OllamaLLM
 from langchain_ollama import OllamaEmbeddings  
 
 
+# 语义缓存：问题向量余弦相似度 >= 阈值即视为同一问题，直接复用答案
+QCACHE_SIZE = 512
+QCACHE_THRESHOLD = 0.95
+QCACHE_TTL = 3600.0  # 秒
+
+# 无需检索的闲聊 / 过短问题：直接交给 LLM，省去 embedding + FAISS 调用
+SMALLTALK_RE = re.compile(
+    r"^\s*(?:hi|hello|hey|thanks?|thank you|ok(?:ay)?|bye|who are you|what(?:'s| is) your name"
+    r"|你好|您好|嗨|哈喽|谢谢|多谢|好的|再见|你是谁|你叫什么(?:名字)?)[\s!！。.,，?？~]*$",
+    re.IGNORECASE,
+)
+MIN_QUERY_CHARS = 4
+
+# 文档目录扫描结果的缓存时长；上传等已知变化通过 invalidate_docs() 立即失效
+SCAN_TTL = 300.0  # 秒
+
+# PDF 解析进程池的启动方式：Web 服务进程里有请求线程、预热线程和 httpx 连接池，
+# 多线程下 fork 可能死锁，改用 forkserver（不支持的平台用 spawn）
+_MP_CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+
+# 分块参数：优先在段落、换行、句末处切分
+CHUNK_TOKENS = 512
+CHUNK_OVERLAP_TOKENS = 50
+CHUNK_SEPARATORS = ["\n\n", "\n", "。", "！", "？", ". ", " ", ""]
+
+# 学术论文常见的章节标题（逐行整行匹配）："3 Method"、"2.1 相关工作"、"Abstract" 等。
+# 编号标题只允许纯字母单词，过滤掉表格行、脚注、参考文献条目等带数字 / 标点的行
+_SECTION_NUM = r"(?:\d{1,2}(?:\.\d{1,2}){0,2}\.?|[IVX]{1,4}\.)"
+SECTION_RE = re.compile(
+    r"[ \t]*(?:"
+    rf"(?:{_SECTION_NUM}[ \t]+)?(?i:Abstract|Introduction|Related Work|Conclusions?|References|Acknowledg(?:e)?ments?)"
+    rf"|(?:{_SECTION_NUM}[ \t]*)?(?:摘要|引言|结论|参考文献)"
+    rf"|{_SECTION_NUM}[ \t]+[A-Z][A-Za-z\-]*(?:[ \t]+[A-Za-z\-]+){{0,7}}"
+    rf"|{_SECTION_NUM}[ \t]*[\u4e00-\u9fff]{{2,20}}"
+    r")[ \t]*"
+)
+# 进入参考文献后不再识别标题（条目常以编号开头）
+REFERENCES_RE = re.compile(r"(?i:references)$|参考文献$")
+
+# 进程内共享的 Ollama HTTP 客户端参数：复用连接池（keep-alive），避免每次请求重新建连
+OLLAMA_CLIENT_KWARGS: Dict[str, Any] = {
+    "timeout": 120,
+    "limits": httpx.Limits(max_keepalive_connections=16, max_connections=32),
+}
+
+# 建库时的 embedding 批大小与并发数（Ollama 端需允许并发请求才能真正并行）
+EMBED_BATCH_SIZE = 64
+EMBED_WORKERS = 4
+
+# FAISS 索引参数：默认 HNSW 图索引 + fp16 标量量化（向量内存 / 带宽为 float32 的 1/2）；
+# 超大语料改用 IVFPQ 压缩
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+IVFPQ_MIN_VECTORS = 1_000_000
+IVF_NPROBE = 16
+
+# 生成模型在 Ollama 中的驻留时长：模型常驻时，相同前缀的 prompt 可复用已缓存的 KV，
+# 省去静态指令部分的 prefill
+LLM_KEEP_ALIVE = "10m"
+# 空闲超过该时长后生成模型可能已被卸载，提问时先异步触发加载，
+# 使模型加载与 embedding + 检索重叠进行
+LLM_IDLE_RELOAD = 540.0  # 秒
+
+# 多文档对比的固定指令：直接作为 prompt 开头（不套 qa_prompt 模板），
+# 保证每次对比请求的前缀逐字相同，随检索结果/文档列表变化的部分放在末尾
+COMPARE_PROMPT_PREFIX = """
+请基于以下学术文档的内容，分析并回答：
+
+1. 这些文档研究的核心问题是什么？相似点和不同点？
+2. 这些文档采用了什么研究方法？方法论异同？
+3. 这些文档的研究思路/框架有哪些特点？
+4. 基于这些文档，推荐值得进一步探索的研究问题。
+5. 还有哪些可行的方法或角度？
+
+请尽量引用上下文依据，给出具体、可操作的建议。
+""".strip()
+
+
+class NormalizedOllamaEmbeddings(OllamaEmbeddings):
+    """输出 L2 归一化向量的 OllamaEmbeddings。
+
+    文档向量与查询向量都归一化后，内积即余弦相似度，索引可直接用
+    METRIC_INNER_PRODUCT，检索时无需再做开方。
+    """
+
+    @staticmethod
+    def _normalize(vectors: List[List[float]]) -> List[List[float]]:
+        arr = np.ascontiguousarray(vectors, dtype=np.float32)
+        faiss.normalize_L2(arr)
+        return arr.tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._normalize(super().embed_documents(texts))
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._normalize([super().embed_query(text)])[0]
+
+
+_GPU_RES: Any = None
+
+
+def _gpu_resources() -> Any:
+    """返回 FAISS GPU 资源；faiss-cpu 或没有 CUDA 设备时返回 None"""
+    global _GPU_RES
+    if _GPU_RES is None:
+        try:
+            _GPU_RES = faiss.StandardGpuResources() if faiss.get_num_gpus() > 0 else False
+        except Exception:
+            _GPU_RES = False
+    return _GPU_RES or None
+
+
+def _file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def _has_token_encoding() -> bool:
+    """tiktoken 首次取编码需联网下载 BPE 文件，只尝试一次（之后进程内缓存）；
+    未安装或离线取不到编码时返回 False。放在首次分块时而非导入时执行，
+    PDF 解析子进程导入本模块不会各自触发下载。"""
+    if tiktoken is None:
+        return False
+    try:
+        tiktoken.get_encoding("cl100k_base")
+        return True
+    except Exception:
+        return False
+
+
+def _load_one(path: str) -> Tuple[str, List[Document], str | None]:
+    """在子进程中解析单个 PDF，返回 (文件名, 页列表, 错误信息)。
+
+    必须是模块级函数才能被 ProcessPoolExecutor pickle；
+    异常在这里就地捕获，单个坏文件不会拖垮整个进程池。
+    """
+    name = Path(path).name
+    try:
+        docs = PDFLoader(path).load()
+    except Exception as e:
+        return name, [], str(e)
+
+    # 页的章节取页内第一个标题（没有则沿用上一页的最后一个标题）
+    section = ""
+    for d in docs:
+        d.metadata["source_file"] = name
+        headings: List[str] = []
+        if not REFERENCES_RE.search(section):
+            headings = [line.strip() for line in d.page_content.splitlines() if SECTION_RE.fullmatch(line)]
+        page_section = headings[0] if headings else section
+        if headings:
+            section = headings[-1]
+        if page_section:
+            d.metadata["section"] = page_section
+    return name, docs, None
+
+
+class _LazyDoc(Sequence):
+    """documents_data 中的轻量占位：只记录页数，真正访问页内容时才解析 PDF。
+
+    热启动时从清单恢复文档列表，list / compare 等只需要文件名和页数的操作
+    不再触发任何 PDF I/O。
+    """
+
+    def __init__(self, path: Path, pages: int):
+        self.path = path
+        self.pages = pages
+        self._docs: List[Document] | None = None
+
+    def _load(self) -> List[Document]:
+        if self._docs is None:
+            _, docs, err = _load_one(str(self.path))
+            if err is not None:
+                raise RuntimeError(f"加载 {self.path.name} 失败: {err}")
+            self._docs = docs
+        return self._docs
+
+    def __len__(self) -> int:
+        return self.pages if self._docs is None else len(self._docs)
+
+    def __getitem__(self, i):
+        return self._load()[i]
+
+    def __iter__(self):
+        return iter(self._load())
+
+
 class ResearchAssistant:
     def __init__(
         self,
@@ -61,8 +283,30 @@ class ResearchAssistant:
         self.top_k = top_k
 
         self.vectorstore: FAISS | None = None
-        self.qa_chain: Any = None
+        # FAISS（尤其 HNSW）不支持边写边查：原地修改索引 / docstore 与检索互斥
+        self._index_lock = threading.RLock()
+        # 问答 prompt 模板（setup_qa_chain 后就绪）；检索 → 拼 prompt → llm.invoke 直接手写，
+        # 不经过 RetrievalQA 的 Runnable / callback 层
+        self.qa_prompt: str | None = None
         self.documents_data: Dict[str, Any] = {}
+        # 解析失败的 PDF {文件名: 错误信息}；同样记入清单，避免热启动时因其缺席而整体重新解析
+        self._parse_errors: Dict[str, str] = {}
+        self._pdf_files: List[Path] | None = None
+        self._last_scan_ts = 0.0
+
+        # 语义缓存条目: (归一化问题向量, 结果, 写入时间)；_qcache_mat 为对应的连续 float32 矩阵
+        self._qcache: Deque[Tuple[np.ndarray, Dict[str, Any], float]] = deque(maxlen=QCACHE_SIZE)
+        self._qcache_mat: np.ndarray | None = None
+        self._qcache_ns: Tuple[str, str, int] | None = None
+        # Flask 多线程 / SSE 生成器 / compare 后台任务会并发读写缓存；
+        # 矩阵与 deque 必须在同一把锁下配对访问，否则下标可能错位到相邻问题的答案
+        self._qcache_lock = threading.RLock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        # 生成模型预热：单线程后台执行，_llm_last_used 记录最近一次调用生成模型的时间
+        self._prefetch = ThreadPoolExecutor(max_workers=1)
+        self._llm_last_used = float("-inf")  # monotonic 从开机起计，不能用 0 表示"从未调用"
 
         self.docs_folder.mkdir(parents=True, exist_ok=True)
         self.index_dir.mkdir(parents=True, exist_ok=True)
@@ -72,135 +316,628 @@ class ResearchAssistant:
         print(f"[初始化] Embedding模型: {self.embed_model}")
         print(f"[初始化] 索引目录: {self.index_dir}")
 
+    def _scan_pdfs(self) -> List[Path]:
+        """列出文档目录中的 PDF，结果在 SCAN_TTL 内复用"""
+        now = time.monotonic()
+        if self._pdf_files is None or now - self._last_scan_ts >= SCAN_TTL:
+            self._pdf_files = sorted(self.docs_folder.glob("*.pdf"))
+            self._last_scan_ts = now
+        return self._pdf_files
+
+    def invalidate_docs(self):
+        """文档目录已变化（如上传了新文件）时调用，下次访问强制重新扫描"""
+        self._pdf_files = None
+
     def load_documents(self) -> List:
-        pdf_files = sorted(self.docs_folder.glob("*.pdf"))
+        pdf_files = self._scan_pdfs()
         if not pdf_files:
             print(f"警告：在 {self.docs_folder} 中没有找到 PDF 文件")
             return []
 
         print(f"\n[加载文档] 找到 {len(pdf_files)} 个 PDF 文件")
+        return self._parse_pdfs(pdf_files)
+
+    def _parse_pdfs(self, pdf_files: List[Path]) -> List:
         all_docs = []
-        for pdf in pdf_files:
-            print(f"  - 正在加载: {pdf.name}")
-            try:
-                loader = PyPDFLoader(str(pdf))
-                docs = loader.load()
-                for d in docs:
-                    d.metadata["source_file"] = pdf.name
-                all_docs.extend(docs)
-                self.documents_data[pdf.name] = docs
-                print(f"    ✓ 成功加载 {len(docs)} 页")
-            except Exception as e:
-                print(f"    ✗ 加载失败: {e}")
+        paths = [str(p) for p in pdf_files]
+        if len(paths) == 1:
+            # 单文件（常见于增量上传）直接在当前进程解析，省去启动进程池的开销
+            results = map(_load_one, paths)
+        else:
+            # 子进程只负责解析，结果统一在主进程里汇总
+            workers = min(os.cpu_count() or 1, len(paths))
+            with ProcessPoolExecutor(max_workers=workers, mp_context=_MP_CONTEXT) as ex:
+                results = list(ex.map(_load_one, paths))
+
+        for name, docs, err in results:
+            if err is not None:
+                print(f"  ✗ {name} 加载失败: {err}")
+                self._parse_errors[name] = err
+                continue
+            self._parse_errors.pop(name, None)
+            all_docs.extend(docs)
+            self.documents_data[name] = docs
+            print(f"  ✓ {name} 成功加载 {len(docs)} 页")
 
         return all_docs
 
-    def _embeddings(self) -> OllamaEmbeddings:
-        return OllamaEmbeddings(model=self.embed_model)
+    # ---------- 文档清单（已入库 PDF 的内容哈希 / 页数 / 修改时间） ----------
+    # 用于增量更新去重，以及热启动时跳过 PDF 解析直接恢复 documents_data
+    @property
+    def _manifest_file(self) -> Path:
+        return self.index_dir / "manifest.json"
+
+    def _load_manifest(self) -> Dict[str, Dict[str, Any]]:
+        try:
+            with open(self._manifest_file, "r", encoding="utf-8") as f:
+                files = json.load(f).get("files", {})
+        except (OSError, ValueError):
+            return {}
+        # 兼容旧格式 {name: sha256}
+        return {name: v if isinstance(v, dict) else {"sha256": v} for name, v in files.items()}
+
+    def _save_manifest(self, files: Dict[str, Dict[str, Any]]):
+        with open(self._manifest_file, "w", encoding="utf-8") as f:
+            json.dump({"files": files}, f, ensure_ascii=False, indent=2)
+
+    def _manifest_entry(self, name: str, digest: str | None = None) -> Dict[str, Any]:
+        path = self.docs_folder / name
+        entry: Dict[str, Any] = {"sha256": digest or _file_sha256(path), "mtime": path.stat().st_mtime}
+        if name in self._parse_errors:
+            entry["error"] = self._parse_errors[name]
+        else:
+            entry["pages"] = len(self.documents_data.get(name, ()))
+        return entry
+
+    def restore_documents(self) -> bool:
+        """清单与磁盘一致（文件集合、修改时间都未变）且索引存在时，
+        直接用清单恢复 documents_data（页内容按需加载），返回是否成功。"""
+        if not (self.index_dir / "index.faiss").exists():
+            return False
+        manifest = self._load_manifest()
+        pdf_files = {p.name: p for p in self._scan_pdfs()}
+        if not manifest or manifest.keys() != pdf_files.keys():
+            return False
+        for name, entry in manifest.items():
+            if "pages" not in entry and "error" not in entry:
+                return False
+            # 扫描结果在 SCAN_TTL 内复用，期间被删除的文件 stat 会失败，按"无法恢复"处理
+            try:
+                if entry.get("mtime") != pdf_files[name].stat().st_mtime:
+                    return False
+            except OSError:
+                self.invalidate_docs()
+                return False
+
+        # 记录为解析失败且文件未变的 PDF 不再重试
+        self._parse_errors = {name: e["error"] for name, e in manifest.items() if "error" in e}
+        self.documents_data = {
+            name: _LazyDoc(pdf_files[name], manifest[name]["pages"])
+            for name in sorted(manifest)
+            if "error" not in manifest[name]
+        }
+        print(f"\n[加载文档] 从清单恢复 {len(self.documents_data)} 个文档（未变化，跳过解析）")
+        return True
+
+    def _deleted_sources(self) -> List[str]:
+        """清单中已从磁盘删除的文档"""
+        return [name for name in self._load_manifest() if not (self.docs_folder / name).exists()]
+
+    # embedding、生成与模型预加载共用同一个 ollama.Client（一个 httpx 连接池）：
+    # langchain-ollama 构造时会各自新建同步客户端，这里替换为共享实例
+    @cached_property
+    def _ollama(self) -> ollama.Client:
+        return ollama.Client(**OLLAMA_CLIENT_KWARGS)
+
+    @cached_property
+    def embeddings(self) -> OllamaEmbeddings:
+        embeddings = NormalizedOllamaEmbeddings(model=self.embed_model, client_kwargs=OLLAMA_CLIENT_KWARGS)
+        embeddings._client = self._ollama
+        return embeddings
+
+    @cached_property
+    def llm(self) -> OllamaLLM:
+        llm = OllamaLLM(
+            model=self.model_name,
+            temperature=0.3,
+            keep_alive=LLM_KEEP_ALIVE,
+            client_kwargs=OLLAMA_CLIENT_KWARGS,
+        )
+        llm._client = self._ollama
+        return llm
+
+    def _embed_chunks(
+        self, chunks: List[Document], embeddings: OllamaEmbeddings
+    ) -> Tuple[List[str], List[Dict[str, Any]], List[List[float]]]:
+        """分批并发调用 embed_documents，返回与 chunks 顺序一致的 (文本, 元数据, 向量)"""
+        batches = [chunks[i : i + EMBED_BATCH_SIZE] for i in range(0, len(chunks), EMBED_BATCH_SIZE)]
+        results: List[List[List[float]] | None] = [None] * len(batches)
+
+        total = len(chunks)
+        done = 0
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=EMBED_WORKERS) as ex:
+            futures = {
+                ex.submit(embeddings.embed_documents, [c.page_content for c in batch]): i
+                for i, batch in enumerate(batches)
+            }
+            for fut in as_completed(futures):
+                i = futures[fut]
+                results[i] = fut.result()
+                done += len(batches[i])
+                elapsed = time.monotonic() - start
+                rate = done / elapsed * 60 if elapsed > 0 else 0.0
+                eta = (total - done) / rate * 60 if rate > 0 else 0.0
+                print(f"  - {done}/{total} ETA {eta:.0f}s @ {rate:.0f}/min")
+
+        texts = [c.page_content for c in chunks]
+        metadatas = [c.metadata for c in chunks]
+        vectors = [v for batch_vectors in results for v in batch_vectors]
+        return texts, metadatas, vectors
+
+    @staticmethod
+    def _new_index(vecs: np.ndarray) -> faiss.Index:
+        """按语料规模选择索引类型并完成训练 / 写入（向量已归一化，统一用内积度量）"""
+        n, d = vecs.shape
+        if _gpu_resources() is not None:
+            # GPU 上精确暴力检索（cuBLAS GEMM）已足够快，且 HNSW 不支持 GPU
+            index = faiss.IndexFlatIP(d)
+        elif n >= IVFPQ_MIN_VECTORS:
+            nlist = int(math.sqrt(n))
+            # PQ 子空间数需整除维度
+            m = max(k for k in range(1, 65) if d % k == 0)
+            index = faiss.IndexIVFPQ(
+                faiss.IndexFlatIP(d), d, nlist, m, 8, faiss.METRIC_INNER_PRODUCT
+            )
+            index.train(vecs)
+        else:
+            # 不用 int8：其各维取值范围只在首批语料上学习一次，之后增量加入的
+            # 其他主题向量会被截断；fp16 无需学习范围，增量入库不受影响
+            index = faiss.IndexHNSWSQ(d, faiss.ScalarQuantizer.QT_fp16, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+            index.train(vecs)
+        index.add(vecs)
+        return index
+
+    @staticmethod
+    def _to_gpu(index: faiss.Index) -> faiss.Index:
+        """有可用 GPU 时把索引搬到 GPU；索引类型不支持时保留在 CPU"""
+        res = _gpu_resources()
+        if res is None:
+            return index
+        try:
+            return faiss.index_cpu_to_gpu(res, 0, index)
+        except Exception:
+            return index
+
+    def _save_vectorstore(self):
+        # GPU 索引不能直接写盘，保存时临时换成 CPU 副本
+        index = self.vectorstore.index
+        if _gpu_resources() is not None and isinstance(index, faiss.GpuIndex):
+            self.vectorstore.index = faiss.index_gpu_to_cpu(index)
+            try:
+                self.vectorstore.save_local(str(self.index_dir))
+            finally:
+                self.vectorstore.index = index
+        else:
+            self.vectorstore.save_local(str(self.index_dir))
+
+    @staticmethod
+    def _tune_index(index: faiss.Index):
+        """设置查询期参数（这些参数不随索引文件持久化）"""
+        if hasattr(index, "hnsw"):
+            index.hnsw.efSearch = HNSW_EF_SEARCH
+        elif hasattr(index, "nprobe"):
+            index.nprobe = IVF_NPROBE
+
+    def _new_vectorstore(
+        self,
+        texts: List[str],
+        metadatas: List[Dict[str, Any]],
+        vectors: List[List[float]],
+        embeddings: OllamaEmbeddings,
+    ) -> FAISS:
+        index = self._to_gpu(self._new_index(np.ascontiguousarray(vectors, dtype=np.float32)))
+        self._tune_index(index)
+
+        ids = [str(uuid.uuid4()) for _ in texts]
+        docstore = InMemoryDocstore(
+            {i: Document(page_content=t, metadata=m) for i, t, m in zip(ids, texts, metadatas)}
+        )
+        return FAISS(
+            embedding_function=embeddings,
+            index=index,
+            docstore=docstore,
+            index_to_docstore_id=dict(enumerate(ids)),
+            distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+        )
 
     def build_or_load_vectorstore(self, documents: List):
-        if not documents:
-            raise ValueError("没有文档可以构建向量库")
+        """加载本地索引，或用 documents 重建。
 
+        documents 为空时（由 restore_documents 恢复的热启动）只在需要重建时
+        才从 documents_data 按需解析页内容。
+        """
         index_file = self.index_dir / "index.faiss"
         store_file = self.index_dir / "index.pkl"
-        embeddings = self._embeddings()
+        embeddings = self.embeddings
+
+        # 已删除文档的文本块无法从 HNSW 索引中移除，只能整体重建
+        deleted = [] if self.rebuild_index else self._deleted_sources()
+        if deleted:
+            print(f"\n[加载向量库] 检测到已删除的文档 {', '.join(deleted)}，整体重建索引")
 
-        if (index_file.exists() and store_file.exists()) and not self.rebuild_index:
+        if (index_file.exists() and store_file.exists()) and not self.rebuild_index and not deleted:
             print("\n[加载向量库] 检测到本地索引，正在加载 ...")
             try:
                 self.vectorstore = FAISS.load_local(
                     str(self.index_dir),
                     embeddings,
                     allow_dangerous_deserialization=True,
+                    distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
                 )
+                if self.vectorstore.index.metric_type != faiss.METRIC_INNER_PRODUCT:
+                    raise ValueError("旧版 L2 索引，与归一化向量不兼容")
+                self.vectorstore.index = self._to_gpu(self.vectorstore.index)
+                self._tune_index(self.vectorstore.index)
+                self.clear_query_cache()
                 print("  ✓ 向量库加载完成")
                 return
             except Exception as e:
                 print(f"  ✗ 加载失败（将改为重建）: {e}")
 
-        print("\n[构建向量库] 正在分langchain_community割文档 ...")
-        splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,
-            chunk_overlap=200,
-            length_function=len,
-        )
-        chunks = splitter.split_documents(documents)
+        if not documents:
+            documents = [page for doc in self.documents_data.values() for page in doc]
+        if not documents:
+            raise ValueError("没有文档可以构建向量库")
+
+        print("\n[构建向量库] 正在分割文档 ...")
+        chunks = self._split(documents)
         print(f"  - 文档分割为 {len(chunks)} 个文本块")
 
         print("[构建向量库] 正在生成向量并创建 FAISS 索引 ...")
-        self.vectorstore = FAISS.from_documents(chunks, embeddings)
+        texts, metadatas, vectors = self._embed_chunks(chunks, embeddings)
+        self.vectorstore = self._new_vectorstore(texts, metadatas, vectors, embeddings)
 
         print("[构建向量库] 正在保存索引到本地 ...")
-        self.vectorstore.save_local(str(self.index_dir))
+        with self._index_lock:
+            self._save_vectorstore()
+        sources = {d.metadata.get("source_file") for d in documents} | self._parse_errors.keys()
+        self._save_manifest(
+            {
+                name: self._manifest_entry(name)
+                for name in sorted(sources)
+                if name and (self.docs_folder / name).exists()
+            }
+        )
+        self.clear_query_cache()
         print("  ✓ 向量库构建并保存完成")
 
+    def _split(self, documents: List) -> List[Document]:
+        # 按页分块（每页一个 Document），页内先按段落、再按句子切分；页码/章节元数据随块保留
+        if _has_token_encoding():
+            splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+                encoding_name="cl100k_base",
+                chunk_size=CHUNK_TOKENS,
+                chunk_overlap=CHUNK_OVERLAP_TOKENS,
+                separators=CHUNK_SEPARATORS,
+            )
+        else:
+            splitter = RecursiveCharacterTextSplitter(
+                chunk_size=1000,
+                chunk_overlap=200,
+                length_function=len,
+                separators=CHUNK_SEPARATORS,
+            )
+        return splitter.split_documents(documents)
+
+    def add_documents(self, paths: Iterable[Path], digests: Dict[str, str] | None = None) -> int:
+        """增量入库：只解析、嵌入新上传（或内容变化）的 PDF，返回新增文本块数量。
+
+        已入库且内容哈希未变的文件直接跳过；同名但内容变化的文件无法从索引中
+        原地替换，此时退回整体重建。digests 为调用方已算好的 {文件名: sha256}，
+        缺失的再从磁盘计算。
+        """
+        if not self.vectorstore:
+            raise RuntimeError("向量库未初始化")
+
+        manifest = self._load_manifest()
+        new_files: List[Path] = []
+        known = digests or {}
+        digests = {}
+        modified = False
+        for p in map(Path, paths):
+            digest = known.get(p.name) or _file_sha256(p)
+            if manifest.get(p.name, {}).get("sha256") == digest:
+                print(f"  - 跳过未变化的文档: {p.name}")
+                continue
+            # 之前解析失败的文件从未入库，换了内容也只需增量加入
+            modified = modified or (p.name in manifest and "error" not in manifest[p.name])
+            new_files.append(p)
+            digests[p.name] = digest
+
+        if not new_files:
+            return 0
+
+        if modified:
+            print("\n[更新向量库] 检测到已入库文档内容变化，整体重建索引 ...")
+            self.documents_data.clear()
+            docs = self.load_documents()
+            prev_rebuild = self.rebuild_index
+            self.rebuild_index = True
+            try:
+                self.build_or_load_vectorstore(docs)
+            finally:
+                self.rebuild_index = prev_rebuild
+            return len(self.vectorstore.index_to_docstore_id)
+
+        print(f"\n[更新向量库] 增量加入 {len(new_files)} 个文档 ...")
+        docs = self._parse_pdfs(new_files)
+        parsed = {d.metadata.get("source_file") for d in docs}
+        manifest.update(
+            {
+                name: self._manifest_entry(name, h)
+                for name, h in digests.items()
+                if name in parsed or name in self._parse_errors
+            }
+        )
+        chunks = self._split(docs)
+        if not chunks:
+            self._save_manifest(manifest)
+            return 0
+        print(f"  - 新文档分割为 {len(chunks)} 个文本块")
+
+        texts, metadatas, vectors = self._embed_chunks(chunks, self.embeddings)
+        with self._index_lock:
+            self.vectorstore.add_embeddings(list(zip(texts, vectors)), metadatas=metadatas)
+            self._save_vectorstore()
+
+        self._save_manifest(manifest)
+        self.clear_query_cache()
+        print("  ✓ 增量更新完成")
+        return len(chunks)
+
     def setup_qa_chain(self):
         if not self.vectorstore:
             raise RuntimeError("向量库未初始化")
 
         print("\n[初始化QA系统] 正在连接本地 LLM ...")
-        llm = OllamaLLM(model=self.model_name, temperature=0.3)
+        _ = self.llm  # 提前创建客户端
 
-        template = (
+        self.qa_prompt = (
             "使用以下检索到的上下文信息来回答问题。如果你不知道答案，请直接说不知道，不要编造答案。\n"
             "请用中文回答，并尽量详细和准确。\n\n"
             "上下文信息：\n{context}\n\n"
             "问题: {question}\n\n"
             "详细回答:"
         )
-        prompt = PromptTemplate(template=template, input_variables=["context", "question"])
-
-        self.qa_chain = RetrievalQA.from_chain_type(
-            llm=llm,
-            chain_type="stuff",
-            retriever=self.vectorstore.as_retriever(search_kwargs={"k": self.top_k}),
-            return_source_documents=True,
-            chain_type_kwargs={"prompt": prompt},
-        )
         print("  ✓ QA系统初始化完成")
 
+    def _retrieve(self, qvec: np.ndarray) -> List[Document]:
+        # 直接用已算好的问题向量检索，避免再做一次 embedding
+        with self._index_lock:
+            return self.vectorstore.similarity_search_by_vector(qvec.tolist(), k=self.top_k)
+
+    def indexed_files(self) -> Dict[str, str]:
+        """已入库文档 {文件名: sha256}"""
+        return {name: entry.get("sha256", "") for name, entry in self._load_manifest().items()}
+
+    def chunk_count(self, names: Iterable[str]) -> int:
+        """索引中属于指定文档的文本块数量"""
+        names = set(names)
+        with self._index_lock:
+            return sum(
+                1 for d in self.vectorstore.docstore._dict.values() if d.metadata.get("source_file") in names
+            )
+
+    def _build_prompt(self, question: str, docs: List[Document]) -> str:
+        context = "\n\n".join(d.page_content for d in docs)
+        return self.qa_prompt.format(context=context, question=question)
+
+    def clear_query_cache(self):
+        """清空语义缓存（索引变化后旧答案不再可靠）"""
+        with self._qcache_lock:
+            self._qcache.clear()
+            self._qcache_mat = None
+
+    def _embed_question(self, question: str) -> np.ndarray:
+        # embed_query 已做 L2 归一化，点积即余弦相似度
+        return np.asarray(self.embeddings.embed_query(question), dtype=np.float32)
+
+    def _qcache_get(self, qvec: np.ndarray) -> Dict[str, Any] | None:
+        """查询语义缓存并更新命中计数"""
+        with self._qcache_lock:
+            cached = self._qcache_lookup(qvec)
+            if cached is not None:
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+            hits, misses = self.cache_hits, self.cache_misses
+        if cached is not None:
+            print(f"[缓存命中] 复用相似问题的答案 (命中 {hits} / 未命中 {misses})")
+        return cached
+
+    def _qcache_lookup(self, qvec: np.ndarray) -> Dict[str, Any] | None:
+        # 调用方需持有 _qcache_lock
+        # 配置变化（模型 / embedding / top_k）时整体失效，避免不同配置的答案互相污染
+        ns = (self.model_name, self.embed_model, self.top_k)
+        if ns != self._qcache_ns:
+            self.clear_query_cache()
+            self._qcache_ns = ns
+
+        # 淘汰过期条目（deque 按写入时间有序，只需从左侧弹出）
+        now = time.monotonic()
+        expired = False
+        while self._qcache and now - self._qcache[0][2] > QCACHE_TTL:
+            self._qcache.popleft()
+            expired = True
+        if expired:
+            self._rebuild_qcache_mat()
+
+        if self._qcache_mat is None or self._qcache_mat.shape[1] != qvec.shape[0]:
+            return None
+
+        sims = self._qcache_mat @ qvec
+        best = int(np.argmax(sims))
+        if sims[best] < QCACHE_THRESHOLD:
+            return None
+        return self._qcache[best][1]
+
+    def _qcache_store(self, qvec: np.ndarray, result: Dict[str, Any]):
+        with self._qcache_lock:
+            self._qcache.append((qvec, result, time.monotonic()))
+            self._rebuild_qcache_mat()
+
+    def _rebuild_qcache_mat(self):
+        if self._qcache:
+            self._qcache_mat = np.ascontiguousarray(np.vstack([e[0] for e in self._qcache]))
+        else:
+            self._qcache_mat = None
+
+    def _preload_llm(self):
+        """生成模型可能已被 Ollama 卸载时，在后台发一个空 prompt 触发加载。
+
+        不等待结果：随后的检索（embedding + FAISS）与模型加载并行，
+        真正的生成请求到达时模型已在（或正在）载入显存。
+        """
+        now = time.monotonic()
+        if now - self._llm_last_used < LLM_IDLE_RELOAD:
+            return
+        self._llm_last_used = now
+
+        def _load():
+            try:
+                self._ollama.generate(model=self.model_name, prompt="", keep_alive=LLM_KEEP_ALIVE)
+            except Exception as e:
+                print(f"[预热] 生成模型加载失败: {e}")
+
+        self._prefetch.submit(_load)
+
+    def _needs_retrieval(self, question: str) -> bool:
+        """粗略判断问题是否需要检索文档（规则判断，不调用模型）"""
+        q = question.strip()
+        if SMALLTALK_RE.match(q):
+            return False
+        # 提到了某篇文档（按文件名），即使很短也要检索
+        lowered = q.lower()
+        if any(Path(name).stem.lower() in lowered for name in self.documents_data):
+            return True
+        return len(q) >= MIN_QUERY_CHARS
+
+    def _prepare(
+        self, question: str, build_prompt: Callable[[str, List[Document]], str] | None = None
+    ) -> Tuple[str, List[Document], np.ndarray | None, Dict[str, Any] | None]:
+        """ask / ask_stream / compare_documents 共用的前半段：闲聊判断、预热、embedding、语义缓存、检索、拼 prompt。
+
+        返回 (prompt, docs, qvec, cached)；cached 非空表示缓存命中，直接复用即可。
+        qvec 为 None 表示未走检索（结果也不写入缓存）。
+        build_prompt 默认使用 qa_prompt 模板。
+        """
+        if not self._needs_retrieval(question):
+            print("[处理中] 无需检索，直接生成回答 ...")
+            return question, [], None, None
+
+        # 模型加载与问题 embedding / 检索并行
+        self._preload_llm()
+        qvec = self._embed_question(question)
+        cached = self._qcache_get(qvec)
+        if cached is not None:
+            return "", [], qvec, cached
+
+        print("[处理中] 正在检索相关文档并生成答案 ...")
+        docs = self._retrieve(qvec)
+        return (build_prompt or self._build_prompt)(question, docs), docs, qvec, None
+
+    def _finish(
+        self, question: str, answer: str, docs: List[Document], qvec: np.ndarray | None
+    ) -> Dict[str, Any]:
+        self._llm_last_used = time.monotonic()
+        result = {"query": question, "result": answer, "source_documents": docs}
+        if qvec is not None:
+            self._qcache_store(qvec, result)
+        return result
+
     def ask(self, question: str) -> Dict[str, Any]:
-        if not self.qa_chain:
+        if not self.qa_prompt:
             return {"error": "QA系统未初始化"}
 
         print(f"\n[提问] {question}")
-        print("[处理中] 正在检索相关文档并生成答案 ...")
         try:
-            return self.qa_chain.invoke({"query": question})
+            prompt, docs, qvec, cached = self._prepare(question)
+            if cached is not None:
+                return cached
+            return self._finish(question, self.llm.invoke(prompt), docs, qvec)
         except Exception as e:
             return {"error": f"处理问题时出错: {e}"}
 
-    def compare_documents(self) -> Dict[str, Any] | str:
-        if len(self.documents_data) < 2:
-            return "需要至少2个文档才能进行比较"
+    def ask_stream(self, question: str) -> Iterator[Dict[str, Any]]:
+        """ask 的流式版本：逐段产出 {"token": ...}，最后产出与 ask 相同结构的完整结果；
+        出错时产出 {"error": ...}。"""
+        if not self.qa_prompt:
+            yield {"error": "QA系统未初始化"}
+            return
+
+        print(f"\n[提问] {question}")
+        try:
+            prompt, docs, qvec, cached = self._prepare(question)
+            if cached is not None:
+                yield {"token": cached.get("result", "")}
+                yield cached
+                return
 
+            parts: List[str] = []
+            for chunk in self.llm.stream(prompt):
+                parts.append(chunk)
+                yield {"token": chunk}
+            yield self._finish(question, "".join(parts), docs, qvec)
+        except Exception as e:
+            yield {"error": f"处理问题时出错: {e}"}
+
+    def _compare_doc_list(self) -> str:
         doc_names = list(self.documents_data.keys())
-        q = f"""
-我有以下 {len(doc_names)} 篇学术文档：
-{', '.join(doc_names)}
+        return f"文档（共 {len(doc_names)} 篇）：{', '.join(doc_names)}"
 
-请基于这些文档的内容，分析并回答：
+    def _compare_question(self) -> str | None:
+        """对比任务的检索问题（固定指令 + 文档列表）"""
+        if len(self.documents_data) < 2:
+            return None
+        return f"{COMPARE_PROMPT_PREFIX}\n\n{self._compare_doc_list()}"
 
-1. 这些文档研究的核心问题是什么？相似点和不同点？
-2. 这些文档采用了什么研究方法？方法论异同？
-3. 这些文档的研究思路/框架有哪些特点？
-4. 基于这些文档，推荐值得进一步探索的研究问题。
-5. 还有哪些可行的方法或角度？
+    def _build_compare_prompt(self, question: str, docs: List[Document]) -> str:
+        # 固定指令在最前，检索上下文与文档列表随后
+        context = "\n\n".join(d.page_content for d in docs)
+        return (
+            f"{COMPARE_PROMPT_PREFIX}\n\n上下文信息：\n{context}\n\n"
+            f"{self._compare_doc_list()}\n\n详细回答:"
+        )
 
-请尽量引用上下文依据，给出具体、可操作的建议。
-""".strip()
-        return self.ask(q)
+    def compare_documents(self) -> Dict[str, Any] | str:
+        q = self._compare_question()
+        if q is None:
+            return "需要至少2个文档才能进行比较"
+        if not self.qa_prompt:
+            return {"error": "QA系统未初始化"}
+
+        print("\n[比较] 多文档对比分析")
+        try:
+            prompt, docs, qvec, cached = self._prepare(q, self._build_compare_prompt)
+            if cached is not None:
+                return cached
+            return self._finish(q, self.llm.invoke(prompt), docs, qvec)
+        except Exception as e:
+            return {"error": f"处理问题时出错: {e}"}
 
     def interactive(self):
         print("\n" + "=" * 60)
         print("欢迎使用个人科研助手系统")
         print("=" * 60)
 
-        docs = self.load_documents()
-        if not docs:
-            print("\n请将 PDF 文件放入 documents 文件夹后重新运行程序")
-            return
+        docs: List = []
+        if self.rebuild_index or not self.restore_documents():
+            docs = self.load_documents()
+            if not docs:
+                print("\n请将 PDF 文件放入 documents 文件夹后重新运行程序")
+                return
 
         self.build_or_load_vectorstore(docs)
         self.setup_qa_chain()
@@ -249,10 +986,9 @@ class ResearchAssistant:
                 print(f"\n回答:\n{result.get('result', '无法生成答案')}")
 
                 if "source_documents" in result:
-                    sources = {d.metadata.get("source_file", "未知") for d in result["source_documents"]}
+                    sources = sorted({d.metadata.get("source_file", "未知") for d in result["source_documents"]})
                     print(f"\n参考来源 ({len(sources)} 个):")
-                    for s in sorted(sources):
-                        print(f"  - {s}")
+                    print("".join(f"  - {s}\n" for s in sources), end="")
 
             except KeyboardInterrupt:
                 print("\n\n感谢使用！再见！")